@@ -12,57 +12,110 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import io
 import os
 import os.path
+import functools
 import logging
-import random
+import queue
+import threading
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
-from matplotlib.collections import PatchCollection
-from matplotlib.patches import Rectangle
-import xml.etree.ElementTree as ET
+from matplotlib.collections import PolyCollection
+from matplotlib.colors import hsv_to_rgb
+from matplotlib.patches import Patch
+from PIL import Image
+try:
+    # lxml parses XML files in C, much faster than ElementTree
+    from lxml import etree as ET
+    HAS_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    HAS_LXML = False
 import geopandas as gpd
+try:
+    # pyogrio reads the whole shapefile in bulk, much faster than fiona
+    import pyogrio  # noqa: F401
+    WORLD_ENGINE = 'pyogrio'
+except ImportError:
+    WORLD_ENGINE = 'fiona'
 
 MATERIALS_FILE = 'materials.xml'   #< file including all available materials
+AREA_COLUMNS = {'lon1': 0, 'lon2': 1, 'lat1': 2, 'lat2': 3}   #< column of each tag of an area in the subregions array
+PNG_OPTIONS = {'compress_level': 1, 'optimize': False}   #< PIL options for PNG files: a fast zlib level, encoding is a noticeable part of the time
+BATCH_RCPARAMS = {'figure.autolayout': False, 'path.simplify_threshold': 1.0}   #< matplotlib settings for the command line: simplify paths as much as possible
 
 
 def list_files(materials_file, material=None):
     """ Read MATERIALS_FILE and list include files.
     Optionaly, only files including a specific material are included.
     This function assumes that all region files are in the same directory that MATERIALS_FILE,
-    and they only the filename is returned.    
+    and they are returned as paths in that directory. Files missing in that directory are skipped.
     
     Params:
         materials_file: path to the MATERIALS_FILE file.
     
     Return:
-        The available files, in priority order as FlightGear understand priority
+        The paths to the available files, in priority order as FlightGear understand priority
     """
-    tree = ET.parse(materials_file)
-    root = tree.getroot()
     parent_directory = os.path.dirname(materials_file)
+    # scan the directory once, instead of checking each region file. The entries already know their paths
+    with os.scandir(parent_directory or '.') as it:
+        available = {entry.name: entry.path for entry in it if entry.is_file()}
     files = []
-    for region in root.findall('region'):
+    # stream the file, in document order. Only the include attribute of regions is needed
+    tag_filter = {'tag': 'region'} if HAS_LXML else {}
+    for _, region in ET.iterparse(materials_file, events=('end',), **tag_filter):
+        if region.tag != 'region':
+            continue
         region_path = region.attrib.get('include', None)
+        region.clear()
         if region_path is None:
             continue
         region_filename = os.path.basename(region_path)
-        region_assumed_path = os.path.join(parent_directory, region_filename)
-        if file_contains_material(region_assumed_path, material):
-            files.append(region_filename)
-    return files
+        if region_filename not in available:
+            logging.warning('Region file not found: %s', os.path.join(parent_directory, region_filename))
+            continue
+        files.append(available[region_filename])
+    if material is None:
+        return files
+    # check the files in parallel. The map keeps the priority order
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        found = list(executor.map(lambda region_path: file_contains_material(region_path, material), files))
+    return [region_path for region_path, contains in zip(files, found) if contains]
 
 
 def file_contains_material(filename, material=None):
     """ Returns True if the file contains the specific material.
-    If material is None, returns True. """
+    If material is None, returns True.
+    Results are cached until the file is modified. """
     if material is None:
         return True
-    tree = ET.parse(filename)
-    root = tree.getroot()
-    for m in root.findall('material'):
+    return _file_contains_material(filename, os.stat(filename).st_mtime_ns, material)
+
+
+@functools.lru_cache(maxsize=4096)
+def _file_contains_material(filename, mtime, material):
+    """ The actual check of file_contains_material(). mtime is only used as part of the cache key """
+    with open(filename, 'rb') as f:
+        content = f.read()
+    # most files do not mention the material at all: a byte search rejects them without parsing.
+    # The name element may have attributes, so its opening tag is not part of the search
+    if '>{}</name>'.format(material).encode('utf-8') not in content:
+        return False
+    # stream the file: stop at the first match, and forget materials already checked
+    # lxml filters the elements by tag itself, ElementTree returns all of them
+    tag_filter = {'tag': 'material'} if HAS_LXML else {}
+    for _, m in ET.iterparse(io.BytesIO(content), events=('end',), **tag_filter):
+        if m.tag != 'material':
+            continue
         for n in m.findall('name'):
             if n.text == material:
                 return True
+        m.clear()
     return False
 
 
@@ -73,51 +126,127 @@ def load_subregions(region_file):
         region_file: Path the XML file to load.
 
     Returns:
-        An array, each item is an array [lon1, lon2, lat1, lat2]
+        A numpy array of shape (N, 4), each row is [lon1, lon2, lat1, lat2]
 
     Raises:
         ValueError if the file cannot be parsed
     """
-    tree = ET.parse(region_file)
+    # lxml can skip comments and blank text while parsing, so they are never visited.
+    # ElementTree already skips comments and buffers the text of each element
+    parser = ET.XMLParser(remove_comments=True, remove_blank_text=True) if HAS_LXML else None
+    tree = ET.parse(region_file, parser=parser)
     root = tree.getroot()
-    subregions = []
-    for area in root.findall('area'):
-        subregions.append([
-            float(area.find('lon1').text), float(area.find('lon2').text),
-            float(area.find('lat1').text), float(area.find('lat2').text)])
+    areas = len(root.findall('area'))
+    subregions = np.empty((areas, 4), dtype=np.float64)
+    # one column at a time: all texts of a coordinate in bulk, converted by numpy.
+    # Only the first element of each area, so a missing value cannot be filled by a repeated one in another area
+    for tag, column in AREA_COLUMNS.items():
+        if HAS_LXML:
+            texts = root.xpath('area/{}[1]/text()'.format(tag))
+        else:
+            texts = [element.text for element in root.findall('area/{}[1]'.format(tag)) if element.text is not None]
+        if len(texts) != areas:
+            raise ValueError('Area without {} in {}'.format(tag, region_file))
+        subregions[:, column] = np.asarray(texts, dtype=np.float64)
     return subregions
 
 
-def create_figure(boundaries=None, figsize=None):
+def create_figure(boundaries=None, figsize=None, dpi=None):
     """ Creates a matplotlib figure
 
     Params:
         boundaries: [min_lon, max_lon, min_lat, max_lat]
         figsize: the figsize param for the matplotlib.figure.Figure
+        dpi: the dpi param for the matplotlib.figure.Figure
 
     Returns:
         A pair (matplotlib.figure.Figure, matplotlib.axes.Axes)
     """
-    fig, ax = plt.subplots(figsize=figsize)
-    if boundaries is not None:
-        ax.set_xlim(boundaries[0], boundaries[1])
-        ax.set_ylim(boundaries[2], boundaries[3])
-    else:
-        ax.set_xlim(-180, 180)
-        ax.set_ylim(-90, 90)
+    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
+    ax.axis(boundaries if boundaries is not None else [-180, 180, -90, 90])
+    # limits are fixed: do not recompute them when adding artists
+    ax.set_autoscale_on(False)
     return fig, ax
 
 
-def plot_world_shape(ax, worldshape='world/ne_110m_land.shp', worldcolor='silver', edgecolor=None):
+@functools.lru_cache(maxsize=4)
+def _load_world(worldshape, bbox=None):
+    """ Loads a SHP file only once. GeoDataFrame.plot() does not modify the frame, so it can be shared.
+    If bbox=(min_lon, min_lat, max_lon, max_lat), only the features intersecting it are returned.
+    They are selected from the cached whole file, which is not read again """
+    if bbox is not None:
+        return _load_world(worldshape, bbox=None).cx[bbox[0]:bbox[2], bbox[1]:bbox[3]]
+    return gpd.read_file(worldshape, engine=WORLD_ENGINE)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_world_edges(worldshape, bbox=None):
+    """ Returns the boundaries of the shapes in a SHP file. They are computed only once """
+    return _load_world(worldshape, bbox=bbox).boundary
+
+
+@functools.lru_cache(maxsize=4)
+def _world_aspect(worldshape):
+    """ Returns the aspect of the whole world shape, as GeoDataFrame.plot(aspect='auto') computes it.
+    A frame filtered by a bbox has other bounds, and plotting it with aspect='auto' would stretch the map """
+    map_df = _load_world(worldshape, bbox=None)
+    if map_df.crs is not None and map_df.crs.is_geographic:
+        bounds = map_df.total_bounds
+        return 1 / np.cos(np.mean([bounds[1], bounds[3]]) * np.pi / 180)
+    return 'equal'
+
+
+def _world_bbox(boundaries):
+    """ Returns the bbox param of _load_world() for some boundaries [min_lon, max_lon, min_lat, max_lat], or None """
+    if boundaries is None:
+        return None
+    return (boundaries[0], boundaries[2], boundaries[1], boundaries[3])
+
+
+def plot_world_shape(ax, worldshape='world/ne_110m_land.shp', worldcolor='silver', edgecolor=None, zorder=1, boundaries=None):
     """ Creates a plot with the world as a background.
 
     Params:
         ax: the matplotlib.axes.Axes
         worldshape: path to the SHP file to load. Use a low detailed shape file.
         worldcolor: color of the shape
+        edgecolor: color of the edges of the shape
+        zorder: the zorder of the shape. Use a zorder over 1 to plot on top of the regions
+        boundaries: [min_lon, max_lon, min_lat, max_lat] or None. If set, only the shapes inside are plotted
+    """
+    map_df = _load_world(worldshape, bbox=_world_bbox(boundaries))
+    map_df.plot(ax=ax, facecolor=worldcolor, edgecolor=edgecolor, zorder=zorder, aspect=_world_aspect(worldshape))
+
+
+def plot_world_edges(ax, worldshape='world/ne_110m_land.shp', edgecolor='silver', zorder=2, boundaries=None):
+    """ Plots the edges of the world. Cheaper than plotting the whole shape again just for the edges.
+
+    Params:
+        ax: the matplotlib.axes.Axes
+        worldshape: path to the SHP file to load. Use a low detailed shape file.
+        edgecolor: color of the edges
+        zorder: the zorder of the edges. By default, on top of the regions
+        boundaries: [min_lon, max_lon, min_lat, max_lat] or None. If set, only the shapes inside are plotted
     """
-    map_df = gpd.read_file(worldshape)
-    map_df.plot(ax=ax, facecolor=worldcolor, edgecolor=edgecolor)
+    edges = _load_world_edges(worldshape, bbox=_world_bbox(boundaries))
+    edges.plot(ax=ax, color=edgecolor, linewidth=plt.rcParams['patch.linewidth'], zorder=zorder, aspect=_world_aspect(worldshape))
+
+
+def _subregions_collection(subregions, facecolor=None, edgecolor="None", alpha=0.5):
+    """ Returns a collection with the rectangles of an array of subregions, or None if there are no subregions.
+    subregions is a numpy array as returned by load_subregions(), or a list of [lon1, lon2, lat1, lat2] """
+    if len(subregions) == 0:
+        return
+    return PolyCollection(_subregions_verts(subregions), facecolor=facecolor, edgecolor=edgecolor, alpha=alpha)
+
+
+def _subregions_verts(subregions):
+    """ Returns the vertices of the rectangles of an array of subregions, as a numpy array of shape (N, 4, 2) """
+    # columns: lon1, lon2, lat1, lat2
+    subregions = np.asarray(subregions, dtype=np.float64)
+    # the vertices of all rectangles in a single indexing. No Rectangle objects are created
+    # corners: (lon1, lat1), (lon2, lat1), (lon2, lat2), (lon1, lat2)
+    return subregions[:, [[0, 2], [1, 2], [1, 3], [0, 3]]]
 
 
 def plot_subregions(filename, ax, facecolor=None, edgecolor="None", alpha=0.5):
@@ -130,31 +259,28 @@ def plot_subregions(filename, ax, facecolor=None, edgecolor="None", alpha=0.5):
         alpha: the alpha value of the shape
 
     Returns:
-        The first Rectangle in the region, if any. Useful for legends
+        A Patch with the color of the region, if there are subregions. Useful for legends
     """
-    subregions = load_subregions(filename)
-    rectangles = []
-    for subregion in subregions:
-        rectangles.append(Rectangle((subregion[0], subregion[2]), subregion[1] - subregion[0], subregion[3] - subregion[2], facecolor=facecolor))
-    if len(rectangles) > 0:
-        ax.add_collection(PatchCollection(rectangles, facecolor=facecolor, edgecolor=edgecolor, alpha=alpha))
-        return rectangles[0]
+    collection = _subregions_collection(load_subregions(filename), facecolor=facecolor, edgecolor=edgecolor, alpha=alpha)
+    if collection is not None:
+        ax.add_collection(collection, autolim=False)
+        # a proxy artist: legends only need the color
+        return Patch(facecolor=facecolor)
     return
 
 
 def random_colors(number):
-    """ Returns a list of random colors for matplotlib """
-    cmap = plt.cm.get_cmap('hsv', number)
-    colors = []
-    for c in range(0, number):
-        colors.append(cmap(c))
-    random.shuffle(colors)
+    """ Returns a numpy array of random RGBA colors for matplotlib, one per row """
+    # hues evenly spaced around the circle. The last one is not red again, as in the hsv colormap
+    hsv = np.column_stack([np.linspace(0, 1, number, endpoint=False), np.ones(number), np.ones(number)])
+    colors = np.column_stack([hsv_to_rgb(hsv), np.ones(number)])
+    np.random.default_rng().shuffle(colors, axis=0)
     return colors
 
 
 def plot_regions(directory, ax, alpha=0.5, edgecolor="None", material=None):
     """ Loads XML files listed in MATERIALS_FILE in a directory and plots them
-    This method uses plot_subregions()
+    The subregions of all files are plotted in a single collection, in priority order
     Each region will have a different random color
 
     Params:
@@ -171,18 +297,131 @@ def plot_regions(directory, ax, alpha=0.5, edgecolor="None", material=None):
     patches = []
     legends = []
     colors = random_colors(len(available_files))
+    all_subregions = []
+    region_colors = []
+    region_sizes = []
     for i, filename in enumerate(available_files):
         try:
-            first_patch = plot_subregions(os.path.join(directory, filename), ax, facecolor=colors[i], edgecolor=edgecolor, alpha=alpha)
-            if first_patch is not None:
-                patches.append(first_patch)
-                legends.append(filename)
+            subregions = load_subregions(filename)
         except ValueError:
-            logging.warning('I cannot process region: %s', os.path.join(directory, filename))
+            logging.warning('I cannot process region: %s', filename)
+            continue
+        if len(subregions) > 0:
+            all_subregions.append(subregions)
+            region_colors.append(i)
+            region_sizes.append(len(subregions))
+            # a proxy artist for the legend
+            patches.append(Patch(facecolor=colors[i]))
+            legends.append(os.path.basename(filename))
+    if len(all_subregions) > 0:
+        # the vertices of all files in a single step, from a single (Total, 4) array
+        verts = _subregions_verts(np.concatenate(all_subregions))
+        # the color of each file, repeated for each of its subregions
+        facecolors = np.repeat(colors[region_colors], region_sizes, axis=0)
+        ax.add_collection(PolyCollection(verts, facecolor=facecolors, edgecolor=edgecolor, alpha=alpha), autolim=False)
     return patches, legends
 
 
-def region_to_png(filename, outdir='.', figsize=None, boundaries=None, facecolor=None, edgecolor='None', alpha=0.5, worldcolor=None, worldshape=None):
+def _iter_subregions(filenames):
+    """ Yields (filename, subregions) for each file, in order.
+    Files are loaded in a background thread, while the caller plots the previous ones.
+    If a file cannot be loaded, subregions is the exception raised by load_subregions() """
+    pending = queue.Queue(maxsize=os.cpu_count() or 1)
+
+    def producer():
+        for filename in filenames:
+            try:
+                pending.put((filename, load_subregions(filename)))
+            except Exception as exc:
+                pending.put((filename, exc))
+        pending.put(None)
+
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        item = pending.get()
+        if item is None:
+            return
+        yield item
+
+
+def _save_png(fig, outfile, bbox=None):
+    """ Saves a figure into a PNG file, cropped to a bounding box.
+    The canvas is drawn once and its pixels are encoded by PIL, skipping the savefig() machinery.
+    If the bounding box does not fit in the figure, for example because of a legend outside the axes,
+    the canvas cannot be cropped to it and savefig() is used instead.
+
+    Params:
+        fig: the matplotlib.figure.Figure. Its dpi is the resolution of the PNG file
+        outfile: path to the PNG file
+        bbox: the matplotlib.transforms.Bbox to crop, in inches. If None, the tight bounding box of the figure
+    """
+    if bbox is None:
+        # no draw needed: if the figure falls back to savefig(), it is rendered only once
+        bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(plt.rcParams['savefig.pad_inches'])
+    figure_bbox = fig.bbox_inches
+    if bbox.x0 < figure_bbox.x0 or bbox.y0 < figure_bbox.y0 or bbox.x1 > figure_bbox.x1 or bbox.y1 > figure_bbox.y1:
+        fig.savefig(outfile, bbox_inches='tight', pil_kwargs=PNG_OPTIONS)
+        return
+    fig.canvas.draw()
+    width, height = fig.canvas.get_width_height()
+    image = Image.frombuffer('RGBA', (width, height), fig.canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1)
+    # PIL counts pixels from the top, matplotlib from the bottom
+    image = image.crop((
+        round(bbox.x0 * fig.dpi), round(height - bbox.y1 * fig.dpi),
+        round(bbox.x1 * fig.dpi), round(height - bbox.y0 * fig.dpi)))
+    image.save(outfile, 'PNG', **PNG_OPTIONS)
+
+
+def regions_to_png(filenames, outdir='.', figsize=None, boundaries=None, facecolor=None, edgecolor='None', alpha=0.5, worldcolor=None, worldshape=None, dpi=100):
+    """ Plots a list of XML region files into PNG files, one for each region.
+    The figure and the world shape are created only once, and reused for all regions.
+
+    Params:
+        filenames: The paths to the XML files.
+        outdir: save the PNG files in this directory. Output PNG will be {outdir}/{filename}.png
+        figsize: the figsize param for the matplotlib.figure.Figure
+        boundaries: [min_lon, max_lon, min_lat, max_lat] or None
+        facecolor: color of the regions
+        edgecolor: color of the subregions
+        alpha: alpha of the regions
+        worldcolor: color of the world shape
+        worldshape: path to the SHP of the world
+        dpi: resolution of the PNG files
+    """
+    os.makedirs(outdir, exist_ok=True)
+    fig, ax = create_figure(figsize=figsize, boundaries=boundaries, dpi=dpi)
+    try:
+        plot_world_shape(ax, worldshape=worldshape, worldcolor=worldcolor, boundaries=boundaries)
+        # plot the world edges on top of the regions
+        plot_world_edges(ax, worldshape=worldshape, edgecolor=worldcolor, boundaries=boundaries)
+        # the limits of the figure do not change: compute the tight bounding box only once
+        bbox = None
+        for filename, subregions in _iter_subregions(filenames):
+            try:
+                name = os.path.basename(filename)
+                outfile = os.path.join(outdir, name + '.png')
+                logging.info('Converting %s into %s', filename, outfile)
+                if isinstance(subregions, Exception):
+                    raise subregions
+                collection = _subregions_collection(subregions, facecolor=facecolor, edgecolor=edgecolor, alpha=alpha)
+                if collection is None:
+                    continue
+                ax.add_collection(collection, autolim=False)
+                ax.set_title(name)
+                if bbox is None:
+                    bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(plt.rcParams['savefig.pad_inches'])
+                try:
+                    _save_png(fig, outfile, bbox)
+                finally:
+                    # leave the figure ready for the next region
+                    collection.remove()
+            except Exception as exc:
+                logging.warning('Cannot process %s: %s', filename, exc)
+    finally:
+        plt.close(fig)
+
+
+def region_to_png(filename, outdir='.', figsize=None, boundaries=None, facecolor=None, edgecolor='None', alpha=0.5, worldcolor=None, worldshape=None, dpi=100):
     """ Plots an XML region file into a PNG file.
     
     Params:
@@ -195,25 +434,32 @@ def region_to_png(filename, outdir='.', figsize=None, boundaries=None, facecolor
         alpha: alpha of the region
         worldcolor: color of the world shape
         worldshape: path to the SHP of the world
+        dpi: resolution of the PNG file
     """
     try:
-        os.makedirs(outdir, exist_ok=True)
-        outfile = os.path.join(outdir, '{}.png'.format(os.path.basename(filename)))
-        logging.info('Converting %s into %s', filename, outfile)
-        fig, ax = create_figure(figsize=figsize, boundaries=boundaries)
-        plot_world_shape(ax, worldshape=worldshape, worldcolor=worldcolor)
-        ax.set_title(os.path.basename(filename))
-        if plot_subregions(filename, ax, facecolor=facecolor, edgecolor=edgecolor, alpha=alpha) is not None:
-            # plot the world edges on top
-            plot_world_shape(ax, worldshape=worldshape, worldcolor="None", edgecolor=worldcolor)
-            fig.savefig(outfile, bbox_inches='tight')        
-        plt.close(fig)
+        regions_to_png([filename], outdir=outdir, figsize=figsize, boundaries=boundaries, facecolor=facecolor, edgecolor=edgecolor, alpha=alpha, worldcolor=worldcolor, worldshape=worldshape, dpi=dpi)
     except Exception as exc:
         logging.warning('Cannot process %s: %s', filename, exc)
 
 
-def directory_to_png(directory, outdir='.', figsize=None, boundaries=None, facecolor=None, edgecolor='None', alpha=0.5, worldcolor=None, worldshape=None):
+def _init_worker(loglevel, rcparams, worldshape, boundaries=None):
+    """ Configures a worker process. Spawned processes do not inherit the logging and matplotlib configuration.
+    The world shape inside the boundaries is loaded before the first region arrives """
+    logging.basicConfig(level=loglevel)
+    # output is always a PNG file: do not initialize any interactive backend
+    matplotlib.use('Agg')
+    plt.rcParams.update(rcparams)
+    try:
+        # same arguments as in plot_world_edges(), or lru_cache would use a different key
+        _load_world_edges(worldshape, bbox=_world_bbox(boundaries))
+    except Exception:
+        # not fatal here: the error is reported when plotting
+        pass
+
+
+def directory_to_png(directory, outdir='.', figsize=None, boundaries=None, facecolor=None, edgecolor='None', alpha=0.5, worldcolor=None, worldshape=None, dpi=100, workers=None):
     """ Plots all XML regions in a directory into PNG files.
+    Files are independent, and they are plotted in parallel. Each process reuses its figure for all its files.
     
     Params:
         directory: The path to directory containing a MATERIALS_FILE.
@@ -225,12 +471,33 @@ def directory_to_png(directory, outdir='.', figsize=None, boundaries=None, facec
         alpha: alpha of the regions
         worldcolor: color of the world shape
         worldshape: path to the SHP of the world    
+        dpi: resolution of the PNG files
+        workers: number of processes. If None, use as many processes as CPUs
     """
-    for filename in list_files(os.path.join(directory, MATERIALS_FILE)):
-        region_to_png(os.path.join(directory, filename), outdir=outdir, figsize=figsize, facecolor=facecolor, edgecolor=edgecolor, alpha=0.5, worldcolor=worldcolor, worldshape=worldshape)
-
-
-def directory_to_single_png(directory, outdir='.', material=None, figsize=None, boundaries=None, edgecolor='None', alpha=0.5, worldcolor=None, worldshape=None, legend=False):
+    filenames = list_files(os.path.join(directory, MATERIALS_FILE))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # spawn, since forking a process that already imported matplotlib is not safe on every platform
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                                initializer=_init_worker,
+                                                initargs=(logging.getLogger().level, {key: plt.rcParams[key] for key in BATCH_RCPARAMS}, worldshape, boundaries)) as executor:
+        # one batch of files for each process
+        futures = {}
+        for i in range(min(workers, len(filenames))):
+            batch = filenames[i::workers]
+            future = executor.submit(regions_to_png, batch, outdir=outdir, figsize=figsize, boundaries=boundaries, facecolor=facecolor, edgecolor=edgecolor, alpha=alpha, worldcolor=worldcolor, worldshape=worldshape, dpi=dpi)
+            futures[future] = batch
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as exc:
+                # for example, the world shape cannot be loaded: none of the files in the batch was plotted
+                for filename in futures[future]:
+                    logging.warning('Cannot process %s: %s', filename, exc)
+
+
+def directory_to_single_png(directory, outdir='.', material=None, figsize=None, boundaries=None, edgecolor='None', alpha=0.5, worldcolor=None, worldshape=None, legend=False, dpi=100):
     """ Plots all XML regions in a directory into a single PNG file.
    
     Params:
@@ -246,6 +513,7 @@ def directory_to_single_png(directory, outdir='.', material=None, figsize=None,
         worldcolor: color of the world shape
         worldshape: path to the SHP of the world
         legend: if True, include a legend
+        dpi: resolution of the PNG file
     """
     os.makedirs(outdir, exist_ok=True)
     if material is not None:
@@ -253,8 +521,8 @@ def directory_to_single_png(directory, outdir='.', material=None, figsize=None,
     else:
         outfile = os.path.join(outdir, '{}.png'.format(os.path.basename(directory)))
     logging.info('Converting %s into %s', directory, outfile)
-    fig, ax = create_figure(figsize=figsize, boundaries=boundaries)
-    plot_world_shape(ax, worldshape=worldshape, worldcolor=worldcolor)
+    fig, ax = create_figure(figsize=figsize, boundaries=boundaries, dpi=dpi)
+    plot_world_shape(ax, worldshape=worldshape, worldcolor=worldcolor, boundaries=boundaries)
     if material is not None:
         ax.set_title('Regions defining {}'.format(material))
     else:
@@ -264,8 +532,8 @@ def directory_to_single_png(directory, outdir='.', material=None, figsize=None,
         # two columns, to the right of the figure
         plt.legend(patches, legends, bbox_to_anchor=(1.05, 1), loc=2, ncol=2)
     # draw the outline of the world on top
-    plot_world_shape(ax, worldshape=worldshape, worldcolor=(0, 0, 0, 0), edgecolor=worldcolor)
-    fig.savefig(outfile, bbox_inches='tight')
+    plot_world_edges(ax, worldshape=worldshape, edgecolor=worldcolor, boundaries=boundaries)
+    _save_png(fig, outfile)
     plt.close(fig)
 
 
@@ -274,6 +542,13 @@ if __name__ == '__main__':
     import sys
     import ast
 
+    def positive_int(value):
+        """ An argparse type for integers greater than 0 """
+        number = int(value)
+        if number < 1:
+            raise argparse.ArgumentTypeError('must be at least 1: {}'.format(value))
+        return number
+
     parser = argparse.ArgumentParser(description='Plot FlightGear\'s regional materials on a world map')
     parser.add_argument('-v', '--verbose', action='store_true', help='Be verbose', default=False)
     parser.add_argument('-o', '--output', help='The output directory', default='.')
@@ -285,8 +560,10 @@ if __name__ == '__main__':
     parser.add_argument('--material', help='In single mode, proccess only files containing this material', default=None)
     parser.add_argument('--legend', action='store_true', help='In single mode, show legend', default=False)
     parser.add_argument('--edgecolor', help='The color of the edges of the subregion', default='None')
-    parser.add_argument('--height', type=float, help='The height of the figure, in inches (DPI=100)', default=9)
-    parser.add_argument('--width', type=float, help='The width of the figure, in inches (DPI=100)', default=12)
+    parser.add_argument('--height', type=float, help='The height of the figure, in inches', default=9)
+    parser.add_argument('--width', type=float, help='The width of the figure, in inches', default=12)
+    parser.add_argument('--dpi', type=int, help='The resolution of the figure, in dots per inch', default=100)
+    parser.add_argument('-j', '--jobs', type=positive_int, help='Number of parallel processes. Defaults to the number of CPUs', default=None)
     parser.add_argument('--boundaries', type=ast.literal_eval, help='Boundaries [minlon,maxlon,minlat,maxlat]', default=None)
     parser.add_argument('input', help='The input XML file, or directory containing a {} file'.format(MATERIALS_FILE))
 
@@ -295,6 +572,10 @@ if __name__ == '__main__':
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
 
+    # output is always a PNG file: do not initialize any interactive backend
+    matplotlib.use('Agg')
+    plt.rcParams.update(BATCH_RCPARAMS)
+
     if not os.path.exists(args.input):
         logging.error('Input path "%s" does not exist', args.input)
         sys.exit(1)
@@ -305,14 +586,14 @@ if __name__ == '__main__':
                 outdir=args.output, figsize=[args.width, args.height], boundaries=args.boundaries,
                 material=args.material, legend=args.legend,
                 edgecolor=args.edgecolor,alpha=args.alpha,
-                worldcolor=args.worldcolor, worldshape=args.worldshape)
+                worldcolor=args.worldcolor, worldshape=args.worldshape, dpi=args.dpi)
         else:
             directory_to_png(args.input,
                 outdir=args.output, figsize=[args.width, args.height], boundaries=args.boundaries,
                 facecolor=args.facecolor, edgecolor=args.edgecolor, alpha=args.alpha,
-                worldcolor=args.worldcolor, worldshape=args.worldshape)
+                worldcolor=args.worldcolor, worldshape=args.worldshape, dpi=args.dpi, workers=args.jobs)
     else:
         region_to_png(args.input,
             outdir=args.output, figsize=[args.width, args.height], boundaries=args.boundaries,
             facecolor=args.facecolor, edgecolor=args.edgecolor, alpha=args.alpha,
-            worldcolor=args.worldcolor, worldshape=args.worldshape)
+            worldcolor=args.worldcolor, worldshape=args.worldshape, dpi=args.dpi)